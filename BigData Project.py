@@ -1,5 +1,5 @@
 # Databricks notebook source
-# MAGIC %pip install yfinance
+# MAGIC %pip install yfinance numba
 
 # COMMAND ----------
 
@@ -11,13 +11,13 @@ spark = SparkSession.builder \
 # COMMAND ----------
 
 import math
-import random
 import time
 
 import numpy as np
 import yfinance as yf
 import seaborn as sns
 import pandas as pd
+from numba import njit, prange, get_num_threads
 
 import matplotlib.pyplot as plt
 from pyspark.sql.functions import col, corr
@@ -33,28 +33,27 @@ from pyspark.ml.feature import VectorAssembler
 # DBTITLE 1,Isolation Forest Implementation using PySpark and Map Reduce
 # ***************************************************************************************************************************************
 # Step 1: Stock data collection from yfinance
-def collect_stock_data(stock='SBUX'):
+def collect_stock_data(stock='SBUX', to_spark=True):
     """
     Collects historical stock data using yfinance.
+    to_spark: if False: skips creating the Spark DataFrame and returns None for it
     """
     print("Collecting stock data for: ", stock)
     stockTicker = yf.Ticker(stock)
     stock_data = stockTicker.history(period="max")
-    stock_data_df = spark.createDataFrame(stock_data)
+    stock_data_df = spark.createDataFrame(stock_data) if to_spark else None
     return stock_data, stock_data_df
 
 # ***************************************************************************************************************************************
 # Step 2: Preprocessing data and Feature selection
-def preprocess_data(dataset_df, compute_correlation=False):
+def preprocess_data(dataset_pd, compute_correlation=False):
     """
-    Preprocesses the stock data and extracting relevant features.
+    Preprocesses the stock data (pandas DataFrame from yfinance) and extracting relevant features.
     """
     print("Preprocessing data...")
     # Drop NaN values
-    dataset_df = dataset_df.dropna()
-    dataset_pd = dataset_df.toPandas()
+    dataset_pd = dataset_pd.dropna()
     if compute_correlation:
-        # Assuming dataset_pd is your Pandas DataFrame
         dataset_correlation = dataset_pd.corr()
         plt.figure(figsize=(12, 8))
         sns.heatmap(dataset_correlation, annot=True, cmap='coolwarm', fmt=".3f")
@@ -62,141 +61,271 @@ def preprocess_data(dataset_df, compute_correlation=False):
         plt.show()
 
     # Open, Close, High and Low are highly correlated, so choosing Open price
-    selected_features = dataset_df.select('Open')
+    selected_features = dataset_pd[['Open']]
     return selected_features
 
 # ***************************************************************************************************************************************
 # Step 3: Construct Isolation forest (group of trees)
-class ExternalNode:
-    def __init__(self, data_points):
-        # Store the data points in this leaf node
-        self.data_points = data_points
-        self.avg_path_length = float('inf')
-
-class InternalNode:
-    def __init__(self, split_attribute, split_value, left_node, right_node):
-        self.split_attribute = split_attribute  # Attribute used for splitting
-        self.split_value = split_value  # Value used for splitting
-        self.left_node = left_node  # Left subtree
-        self.right_node = right_node  # Right subtree
-
-def get_random_attribute_index(dataset):
-    """Selects a random attribute index from the given dataset X."""
-    return np.random.randint(dataset.shape[1])
-
-def get_random_value(max_value, min_value):
-    """Selects a random value within the range defined by max_value and min_value."""
-    return random.uniform(min_value, max_value)
+# Child index marking a leaf node, node indices are stored as uint16
+LEAF_NODE = 0xFFFF
+
+class FlatForest:
+    """
+    Isolation forest stored as 2-D flat arrays, row t holds the nodes of tree t
+    (node 0 is the root). Leaf nodes have LEAF_NODE as left/right child.
+    """
+    def __init__(self, split_attr, split_val, left, right, size, c_table, n_features):
+        self.split_attr = split_attr  # Attribute used for splitting, None for single attribute data
+        self.split_value = split_val  # Value used for splitting
+        self.left = left  # Index of left child
+        self.right = right  # Index of right child
+        self.size = size  # Number of data points in the leaf
+        self.c_table = c_table  # c(size) for every possible leaf size
+        self.n_features = n_features  # Number of attributes in the training data
+
+    def __len__(self):
+        return self.split_value.shape[0]
 
 def construct_forest(dataset, trees_count, subsample_count):
     """
     Construct trees_count with given subsample_count data points.
-    Returns a list of root nodes of trees in the forest.
+    Returns a FlatForest holding the trees in the forest.
     """
     print("Constructing Isolation forest...")
-    tree_indices = spark.sparkContext.parallelize(range(trees_count))
-    forest = tree_indices.map(lambda i: construct_tree_using_subsamples(dataset, subsample_count)).collect()
-    
+    dataset = np.asarray(dataset, dtype=np.float32)
+    max_tree_height = math.ceil(math.log2(subsample_count))
+
+    # Upper bound on the number of nodes of a binary tree with max_tree_height
+    max_nodes = 2 ** (max_tree_height + 1) - 1
+    if max_nodes > LEAF_NODE:
+        raise ValueError("subsample_count is too large, trees must have at most {} nodes".format(LEAF_NODE))
+    if subsample_count > dataset.shape[0]:
+        raise ValueError("subsample_count ({}) is larger than the dataset ({} datapoints)".format(subsample_count, dataset.shape[0]))
+    # With a single attribute every split is on attribute 0, so the builder doesn't record it
+    split_attr = np.zeros((trees_count, max_nodes if dataset.shape[1] > 1 else 1), dtype=np.int16)
+    split_val = np.zeros((trees_count, max_nodes), dtype=np.float32)
+    left = np.full((trees_count, max_nodes), LEAF_NODE, dtype=np.uint16)
+    right = np.full((trees_count, max_nodes), LEAF_NODE, dtype=np.uint16)
+    size = np.zeros((trees_count, max_nodes), dtype=np.uint16)
+
+    # Trees are independent, so they are built in parallel on the driver's cores
+    construct_trees(dataset, subsample_count, max_tree_height, split_attr, split_val, left, right, size)
+    if dataset.shape[1] == 1:
+        split_attr = None
+    forest = FlatForest(split_attr, split_val, left, right, size, compute_c_table(subsample_count), dataset.shape[1])
+
     print("Isolation Forest constructed!")
     return forest
 
-def construct_tree_using_subsamples(dataset, subsample_count):
+@njit(parallel=True)
+def construct_trees(dataset, subsample_count, max_tree_height, split_attr, split_val, left, right, size):
     """
-    Samples a set of datapoints from dataset
+    Builds one tree per row of the flat node arrays, each over its own
+    random sample of subsample_count datapoints from dataset.
     """
-    # Randomly sample the dataset
-    indices = np.random.choice(dataset.shape[0], subsample_count, replace=False)
-    dataset_sample = dataset[indices]
-    max_tree_height = math.ceil(math.log2(subsample_count))
-    return construct_tree(dataset_sample, 0, max_tree_height)
-
-def construct_tree(data, current_height, max_tree_height):
+    trees_count = split_attr.shape[0]
+    # Trees are split into one chunk per thread, each chunk reuses a single index buffer
+    chunks_count = min(get_num_threads(), trees_count)
+    for chunk in prange(chunks_count):
+        permutation = np.arange(dataset.shape[0]).astype(np.int32)
+        for t in range(chunk, trees_count, chunks_count):
+            # Randomly sample the dataset, the tree partitions these indices in place
+            sample_indices(permutation, subsample_count)
+            construct_tree(dataset, permutation[:subsample_count], max_tree_height,
+                           split_attr[t], split_val[t], left[t], right[t], size[t])
+
+@njit
+def sample_indices(permutation, subsample_count):
     """
-    Recurisvely constructs a tree from sampled data.
+    Partial Fisher-Yates shuffle, moves a uniform random sample of
+    subsample_count indices to the front of permutation.
     """
-    print("Constructing tree...")
-    if len(data) == 0:
-        return None
-    if len(data) == 1:
-        return ExternalNode(data)
-    
-    if current_height >= max_tree_height:
-        # Create an external node if maximum height is reached
-        return ExternalNode(data)
-     
-    # Select a random attribute index
-    attribute_index = get_random_attribute_index(data)
-
-    # Select a random split value for the chosen attribute
-    split_value = get_random_value(data[:, attribute_index].max(), data[:, attribute_index].min())
-
-    # Split the data into left and right subsets based on the split value
-    data_left = data[data[:, attribute_index] < split_value]
-    data_right = data[data[:, attribute_index] >= split_value]
+    for k in range(subsample_count):
+        j = np.random.randint(k, permutation.shape[0])
+        permutation[k], permutation[j] = permutation[j], permutation[k]
 
-    # Recursively construct the left and right subtrees
-    left_subtree = construct_tree(data_left, current_height + 1, max_tree_height)
-    right_subtree = construct_tree(data_right, current_height + 1, max_tree_height)
-
-    # Create an internal node for the split
-    return InternalNode(attribute_index, split_value, left_subtree, right_subtree)
+@njit
+def construct_tree(data, indices, max_tree_height, split_attr, split_val, left, right, size):
+    """
+    Iteratively constructs a tree over data[indices] into the flat node arrays.
+    indices is partitioned in place.
+    """
+    # Stack of pending nodes, each row is (lo, hi, height, node) for indices[lo:hi]
+    stack = np.empty((max_tree_height + 1, 4), dtype=np.int64)
+    stack[0, 0] = 0
+    stack[0, 1] = len(indices)
+    stack[0, 2] = 0
+    stack[0, 3] = 0
+    stack_size = 1
+    nodes_count = 1
+
+    while stack_size > 0:
+        stack_size -= 1
+        lo = stack[stack_size, 0]
+        hi = stack[stack_size, 1]
+        height = stack[stack_size, 2]
+        node = stack[stack_size, 3]
+
+        # Create an external node if maximum height is reached or data can't be split,
+        # only its size is kept since that is all the path length needs
+        if hi - lo <= 1 or height >= max_tree_height:
+            size[node] = hi - lo
+            continue
+
+        # Select a random attribute index and a random split value for it
+        attribute_index = 0 if data.shape[1] == 1 else np.random.randint(data.shape[1])
+
+        min_value, max_value = get_attribute_range(data, indices, lo, hi, attribute_index)
+
+        # The attribute is constant over the node, so draw among the attributes that
+        # can still split it. Only when none can is the node an external node.
+        if min_value == max_value:
+            splittable = np.empty(data.shape[1], dtype=np.int64)
+            splittable_count = 0
+            for a in range(data.shape[1]):
+                a_min, a_max = get_attribute_range(data, indices, lo, hi, a)
+                if a_min != a_max:
+                    splittable[splittable_count] = a
+                    splittable_count += 1
+            if splittable_count == 0:
+                size[node] = hi - lo
+                continue
+            attribute_index = splittable[np.random.randint(splittable_count)]
+            min_value, max_value = get_attribute_range(data, indices, lo, hi, attribute_index)
+
+        # Rounded to float32 up front so scoring compares against the same value
+        split_value = np.float32(min_value + np.random.random() * (max_value - min_value))
+
+        # Partition indices[lo:hi] so the points below split_value come first
+        i = lo
+        j = hi - 1
+        while i <= j:
+            if data[indices[i], attribute_index] < split_value:
+                i += 1
+            else:
+                indices[i], indices[j] = indices[j], indices[i]
+                j -= 1
+
+        # Create an internal node for the split and push both subtrees
+        if data.shape[1] > 1:
+            split_attr[node] = attribute_index
+        split_val[node] = split_value
+        left[node] = nodes_count
+        right[node] = nodes_count + 1
+        for child_lo, child_hi in ((lo, i), (i, hi)):
+            stack[stack_size, 0] = child_lo
+            stack[stack_size, 1] = child_hi
+            stack[stack_size, 2] = height + 1
+            stack[stack_size, 3] = nodes_count
+            stack_size += 1
+            nodes_count += 1
+
+@njit
+def get_attribute_range(data, indices, lo, hi, attribute_index):
+    """Returns (min, max) of the attribute over data[indices[lo:hi]] in a single pass."""
+    min_value = data[indices[lo], attribute_index]
+    max_value = min_value
+    for k in range(lo + 1, hi):
+        value = data[indices[k], attribute_index]
+        if value < min_value:
+            min_value = value
+        elif value > max_value:
+            max_value = value
+    return min_value, max_value
 
 # ***************************************************************************************************************************************
 # Step 4: Compute path length for a datapoint in a tree (test instance)
-def is_external_node(node):
-    """Checks if the node is an external (leaf) node."""
-    return isinstance(node, ExternalNode)
-
 def c(node_size):
     """Computes the standardized value to add to path length for a node."""
-    return 2 * (math.log(node_size - 1) + 0.5772156649) - (2 * (node_size - 1) / node_size)
+    return 2 * (np.log(node_size - 1) + 0.5772156649) - (2 * (node_size - 1) / node_size)
 
-def get_path_length(data_point, tree_node, edge_count):
+def compute_c_table(subsample_count):
     """
-    Returns the path length of data_point in the tree
-    edge_count
+    Tabulates c(size) for every leaf size up to subsample_count.
+    Leaves with 0 or 1 data points need no adjustment.
     """
-    if data_point is None or tree_node is None:
-        return edge_count
-    
-    # tree_node is the external node in subtree,
-    # compute the path length and return.
-    if is_external_node(tree_node):
-        if len(tree_node.data_points) == 1:
-            return edge_count
-        return edge_count + c(len(tree_node.data_points))
-    
-    # tree_node is the internal node
-    if data_point[tree_node.split_attribute] < tree_node.split_value:
-        # Traverse left subtree
-        return get_path_length(data_point, tree_node.left_node, edge_count + 1)
-    else:
-        # Traverse right subtree
-        return get_path_length(data_point, tree_node.right_node, edge_count + 1)
+    c_table = np.zeros(subsample_count + 1, dtype=np.float32)
+    c_table[2:] = c(np.arange(2, subsample_count + 1, dtype=np.float32))
+    return c_table
+
+@njit(parallel=True, fastmath=True)
+def compute_path_length_sums(dataset, split_attr, split_val, left, right, size, c_table):
+    """
+    Returns the path length of every data point in dataset summed over all trees.
+    Data points are scored in parallel, each one descending every tree in turn.
+    """
+    path_length_sums = np.empty(dataset.shape[0], dtype=np.float32)
+    for i in prange(dataset.shape[0]):
+        path_length_sum = np.float32(0)
+        for t in range(split_attr.shape[0]):
+            node = 0
+            edge_count = 0
+            while left[t, node] != LEAF_NODE:
+                if dataset[i, split_attr[t, node]] < split_val[t, node]:
+                    node = left[t, node]
+                else:
+                    node = right[t, node]
+                edge_count += 1
+            # Leaves holding more than one data point get the standardized adjustment
+            path_length_sum += np.float32(edge_count) + c_table[size[t, node]]
+        path_length_sums[i] = path_length_sum
+    return path_length_sums
+
+@njit(parallel=True, fastmath=True)
+def compute_path_length_sums_1d(values, split_val, left, right, size, c_table):
+    """
+    compute_path_length_sums specialized for single attribute data,
+    values holds the only attribute so no split attribute is looked up.
+    """
+    path_length_sums = np.empty(values.shape[0], dtype=np.float32)
+    for i in prange(values.shape[0]):
+        value = values[i]
+        path_length_sum = np.float32(0)
+        for t in range(split_val.shape[0]):
+            node = 0
+            edge_count = 0
+            while left[t, node] != LEAF_NODE:
+                if value < split_val[t, node]:
+                    node = left[t, node]
+                else:
+                    node = right[t, node]
+                edge_count += 1
+            path_length_sum += np.float32(edge_count) + c_table[size[t, node]]
+        path_length_sums[i] = path_length_sum
+    return path_length_sums
 
 def compute_anomaly_score(dataset, forest):
-    avg_path_length_list = []
     if forest is None:
         return None
-    for data_point in dataset:
-        avg_path_length = sum(get_path_length(data_point, tree, 0) for tree in forest) / len(forest)
-        avg_path_length_list.append(avg_path_length)
-    anomaly_scores = [pow(2, -avg_path_length) for avg_path_length in avg_path_length_list]
+    dataset = np.asarray(dataset, dtype=np.float32)
+    # The scoring kernels don't check bounds, so the data must match the trained attributes
+    if dataset.ndim != 2 or dataset.shape[1] != forest.n_features:
+        raise ValueError("dataset has shape {}, the forest was trained on {} attributes".format(dataset.shape, forest.n_features))
+    if forest.split_attr is None:
+        # Single attribute data, e.g. only the Open price
+        path_length_sum = compute_path_length_sums_1d(np.ascontiguousarray(dataset[:, 0]), forest.split_value, forest.left,
+                                                      forest.right, forest.size, forest.c_table)
+    else:
+        path_length_sum = compute_path_length_sums(dataset, forest.split_attr, forest.split_value, forest.left,
+                                                   forest.right, forest.size, forest.c_table)
+    # Path lengths are accumulated in float32, the score itself is computed in float64
+    avg_path_lengths = path_length_sum.astype(np.float64) / len(forest)
+    anomaly_scores = np.exp2(-avg_path_lengths)
     return anomaly_scores
 
 def normalize_anomaly_scores(anomaly_scores):
     if anomaly_scores is None:
         return None
-    min_score = min(anomaly_scores)
-    max_score = max(anomaly_scores)
-    normalized_scores = [(score - min_score) / (max_score - min_score) for score in anomaly_scores]
+    min_score = anomaly_scores.min()
+    max_score = anomaly_scores.max()
+    normalized_scores = (anomaly_scores - min_score) / (max_score - min_score)
     return normalized_scores
 
 def compute_anomaly_label(anomaly_scores):
     if anomaly_scores is None:
         return None
     # Using a threshold of 0.5 to compare with sklearn's isolation forest.
-    anomaly_labels = [-1 if score >= 0.5 else 1 for score in anomaly_scores]
+    anomaly_labels = np.where(anomaly_scores >= 0.5, -1, 1)
     return anomaly_labels
 
 
@@ -224,7 +353,8 @@ def compare_results(predicted_anomalies, isolation_forest_anomalies):
     total_samples = len(predicted_anomalies)
 
     # Initialize counts for correct and incorrect anomaly scores
-    correct_count = sum(1 for predicted, iso_forest in zip(predicted_anomalies, isolation_forest_anomalies) if predicted == iso_forest)
+    # Labels may come in as (N, 1) columns, flatten them so they are compared pairwise
+    correct_count = int((np.ravel(predicted_anomalies) == np.ravel(isolation_forest_anomalies)).sum())
     incorrect_count = total_samples - correct_count
 
     # Calculate percentages
@@ -364,15 +494,13 @@ plt.show()
 # COMMAND ----------
 
 # 2. Preprocess and Visualize the data
-preprocessed_df = preprocess_data(dataset_df, compute_correlation=True)
-preprocessed_df_cache = preprocessed_df.cache()
+preprocessed_pd = preprocess_data(dataset_pd, compute_correlation=True)
 visualize_data(dataset_pd)
 
 # COMMAND ----------
 
 # 3. Train isolation forest on train data 
-dataset_broadcast = spark.sparkContext.broadcast(preprocessed_df_cache.collect())
-dataset_val = np.array(dataset_broadcast.value)
+dataset_val = preprocessed_pd['Open'].to_numpy(dtype=np.float32).reshape(-1, 1)
 trees_count = 100
 subsample_count = 512
 
@@ -392,7 +520,7 @@ isolation_forest_anomalies = model.predict(dataset_val)
 
 # 5. Comparing implemented algorithn and sklearn's algorithm
 compare_results(predicted_anomaly_label, isolation_forest_anomalies)
-visualize_data_and_anomalies(dataset_pd, np.array(predicted_anomaly_label), title='Anomalies in Starbucks (SBUX) Stock Price (with own algorithm)')
+visualize_data_and_anomalies(dataset_pd, predicted_anomaly_label, title='Anomalies in Starbucks (SBUX) Stock Price (with own algorithm)')
 visualize_data_and_anomalies(dataset_pd, isolation_forest_anomalies, title='Anomalies in Starbucks (SBUX) Stock Price (with isolation forest)')
 
 # COMMAND ----------
@@ -401,29 +529,33 @@ visualize_data_and_anomalies(dataset_pd, isolation_forest_anomalies, title='Anom
 
 # Testing for anomalies in streaming data
 # Interrupt the execution to visualize the results
-def test_anomaly_real_time(isolation_forest, stock='SBUX', period = '1d', interval = '60m', one=False):
+def test_anomaly_real_time(isolation_forest, stock='SBUX', period = '1d', interval = '60m', one=False, max_rows=4096):
     """
     isolation_forest: trained isolation forest
     stock: Stock Ticker(same as train)
     period: time span of data to download
     interval: time between each data 
     one: if True: tests only the tail datapoint, else uses entire data
+    max_rows: number of most recent tested datapoints kept for visualization
+    Returns a DataFrame of the kept datapoints with their anomaly labels
     """
 
+    # Ring buffer of tested datapoints, filled in place on every fetch
+    tested_dates = np.empty(max_rows, dtype=object)
+    tested_open = np.empty(max_rows, dtype=np.float32)
+    tested_labels = np.empty(max_rows, dtype=np.int8)
+    rows_written = 0
+
     # Create a loop to fetch real-time data at intervals
-    test_data_gathered = []
     while True:
         try:
             # Fetch real-time data for the specified ticker
             ticker = yf.Ticker(stock)
             data = ticker.history(period=period, interval=interval)
 
-            # Preprocess test data
-            downloaded_test_data = data.tail(1) if one else data
-            test_data_df = spark.createDataFrame(downloaded_test_data)
-            preprocessed_test_data = preprocess_data(test_data_df)
-
-            test_data = np.array(preprocessed_test_data.rdd.collect())
+            # Preprocess test data, it is small enough to stay in pandas
+            downloaded_test_data = (data.tail(1) if one else data).dropna()
+            test_data = downloaded_test_data['Open'].to_numpy(dtype=np.float32).reshape(-1, 1)
             predicted_test_anomaly_scores = compute_anomaly_score(test_data, isolation_forest)
             
             # Calculate the anomaly_label for each instance
@@ -432,23 +564,28 @@ def test_anomaly_real_time(isolation_forest, stock='SBUX', period = '1d', interv
             for i in range(test_data.shape[0]):
                 print("Test data point: {}, Anomaly Score: {}, Anomaly Label: {}".format(test_data[i], predicted_test_anomaly_scores[i], predicted_test_anomaly_labels[i]))
 
-            downloaded_test_data['anomaly_score'] = predicted_test_anomaly_labels
-            test_data_gathered.append(downloaded_test_data)
+            rows = np.arange(rows_written, rows_written + test_data.shape[0])[-max_rows:]
+            tested_dates[rows % max_rows] = downloaded_test_data.index[-max_rows:]
+            tested_open[rows % max_rows] = test_data[-max_rows:, 0]
+            tested_labels[rows % max_rows] = predicted_test_anomaly_labels[-max_rows:]
+            rows_written += test_data.shape[0]
             # Sleep for a specified interval before fetching data again
             print("Sleeping for 60 seconds...")
             time.sleep(60)  # Sleep for 60 seconds (1 minute)       
         except KeyboardInterrupt:
             print("Streaming stopped by user.")
-            return test_data_gathered
+            # Oldest to newest kept datapoint
+            rows = np.arange(max(0, rows_written - max_rows), rows_written) % max_rows
+            return pd.DataFrame({'Open': tested_open[rows], 'anomaly_score': tested_labels[rows]},
+                                index=pd.Index(tested_dates[rows]))
         except Exception as e:
             print("An error occurred:", e)
 
-tested_data = test_anomaly_real_time(isolation_forest, 'SBUX', period = '1d', interval = '60m', one=False)
+tested_data_df = test_anomaly_real_time(isolation_forest, 'SBUX', period = '1d', interval = '60m', one=False)
 
 # COMMAND ----------
 
 # 7. Visualize train and test data
-tested_data_df = pd.concat(tested_data)
 print(tested_data_df)
 visualize_test_data(dataset_pd, tested_data_df)
 
@@ -465,9 +602,11 @@ class AnomalyDetectorTransformer(Transformer):
         self.forest = forest
 
     def _transform(self, df):
+        # Bring the feature column to the driver as one float32 array
+        dataset = df.select('Open').toPandas().to_numpy(np.float32)
+
         # Calculate the anomaly_label for each instance (path length)
-        print("Transforming....")
-        anomaly_scores = compute_anomaly_score(df, self.forest)
+        anomaly_scores = compute_anomaly_score(dataset, self.forest)
 
         normalized_scores = normalize_anomaly_scores(anomaly_scores)
 
@@ -484,7 +623,8 @@ class AnomalyDetectorEstimator(Estimator):
 
     def _fit(self, df):
         print("Fitting...")
-        self.forest  = construct_forest(df, self.trees_count, self.subsample_count) 
+        dataset = df.select('Open').toPandas().to_numpy(np.float32)
+        self.forest  = construct_forest(dataset, self.trees_count, self.subsample_count) 
         return AnomalyDetectorTransformer(self.forest)
 
 
@@ -532,86 +672,78 @@ test_data = test_data_with_labels.select(['Open'])
 # COMMAND ----------
 
 # Fit the pipeline to training data
-fitted_pipeline = anomaly_detection_pipeline.fit(np.array(train_data.rdd.collect()))
+fitted_pipeline = anomaly_detection_pipeline.fit(train_data)
 
 # COMMAND ----------
 
-train_data_anomaly_labels = fitted_pipeline.transform(np.array(train_data.collect()))
-compare_results(np.array(train_data_anomaly_labels), np.array(train_data_with_labels.select(['anomaly_label']).rdd.collect()))
+train_data_anomaly_labels = fitted_pipeline.transform(train_data)
+compare_results(train_data_anomaly_labels, train_data_with_labels.select('anomaly_label').toPandas()['anomaly_label'].to_numpy())
 
 # COMMAND ----------
 
-test_data_anomaly_labels = fitted_pipeline.transform(np.array(test_data.rdd.collect()))
-compare_results(np.array(test_data_anomaly_labels), np.array(test_data_with_labels.select(['anomaly_label']).rdd.collect()))
+test_data_anomaly_labels = fitted_pipeline.transform(test_data)
+compare_results(test_data_anomaly_labels, test_data_with_labels.select('anomaly_label').toPandas()['anomaly_label'].to_numpy())
 
 # COMMAND ----------
 
 # DBTITLE 1,Varying Hyper parameters and testing the model:SBUX
 # 1. Collect and Analyze the data
-log_dataset_pd, log_dataset_df = collect_stock_data('SBUX')
+log_dataset_pd, _ = collect_stock_data('SBUX', to_spark=False)
 
 # 2. Preprocess and Visualize the data
-log_preprocessed_df = preprocess_data(log_dataset_df, compute_correlation=True)
-log_preprocessed_df_cache = log_preprocessed_df.cache()
+log_preprocessed_pd = preprocess_data(log_dataset_pd, compute_correlation=True)
 
 # 3. Train isolation forest on train data 
-log_dataset_broadcast = spark.sparkContext.broadcast(log_preprocessed_df_cache.collect())
-log_dataset_val = np.array(log_dataset_broadcast.value)
+log_dataset_val = log_preprocessed_pd['Open'].to_numpy(dtype=np.float32).reshape(-1, 1)
 
 trees_count_list = [50, 100, 150, 200]
 subsample_count_list = [256, 512, 1024]
 
+# 4. Using sklearn's Isolation Forest model with the data, it does not depend on the sweep
+log_isolation_forest_anomalies = IsolationForest(contamination=0.01).fit_predict(log_dataset_val)
+
 for tree_count in trees_count_list:
     for subsample_count in subsample_count_list:
         print("Trees Count: {}, Subsample Count: {}".format(tree_count, subsample_count))
-        log_isolation_forest, log_anomaly_scores = train_isolation_forest(log_dataset_val, trees_count, subsample_count)
+        log_isolation_forest, log_anomaly_scores = train_isolation_forest(log_dataset_val, tree_count, subsample_count)
 
         # Computing anomaly labels to compare with sklearn's isolation forest 
         log_predicted_anomaly_label = compute_anomaly_label(log_anomaly_scores)
 
-        # 4. Using sklearn's Isolation Forest model with the data
-        model = IsolationForest(contamination=0.01)
-        model.fit(log_dataset_val)
-        log_isolation_forest_anomalies = model.predict(log_dataset_val)
-
         # 5. Comparing implemented algorithn and sklearn's algorithm
         compare_results(log_predicted_anomaly_label, log_isolation_forest_anomalies)
-        visualize_data_and_anomalies(log_dataset_pd, np.array(log_predicted_anomaly_label), title='Anomalies in Starbucks (SBUX) Stock Price (with own algorithm)')
+        visualize_data_and_anomalies(log_dataset_pd, log_predicted_anomaly_label, title='Anomalies in Starbucks (SBUX) Stock Price (with own algorithm)')
         visualize_data_and_anomalies(log_dataset_pd, log_isolation_forest_anomalies, title='Anomalies in Starbucks (SBUX) Stock Price (with isolation forest)')
 
 # COMMAND ----------
 
 # DBTITLE 1,Varying Hyper parameters and testing the model:AAPL
 # 1. Collect and Analyze the data
-log_dataset_pd, log_dataset_df = collect_stock_data('AAPL')
+log_dataset_pd, _ = collect_stock_data('AAPL', to_spark=False)
 
 # 2. Preprocess and Visualize the data
-log_preprocessed_df = preprocess_data(log_dataset_df, compute_correlation=True)
-log_preprocessed_df_cache = log_preprocessed_df.cache()
+log_preprocessed_pd = preprocess_data(log_dataset_pd, compute_correlation=True)
 
 # 3. Train isolation forest on train data 
-log_dataset_broadcast = spark.sparkContext.broadcast(log_preprocessed_df_cache.collect())
-log_dataset_val = np.array(log_dataset_broadcast.value)
+log_dataset_val = log_preprocessed_pd['Open'].to_numpy(dtype=np.float32).reshape(-1, 1)
 
 trees_count_list = [50, 100, 150, 200]
 subsample_count_list = [256, 512, 1024]
 
+# 4. Using sklearn's Isolation Forest model with the data, it does not depend on the sweep
+log_isolation_forest_anomalies = IsolationForest(contamination=0.01).fit_predict(log_dataset_val)
+
 for tree_count in trees_count_list:
     for subsample_count in subsample_count_list:
         print("Trees Count: {}, Subsample Count: {}".format(tree_count, subsample_count))
-        log_isolation_forest, log_anomaly_scores = train_isolation_forest(log_dataset_val, trees_count, subsample_count)
+        log_isolation_forest, log_anomaly_scores = train_isolation_forest(log_dataset_val, tree_count, subsample_count)
 
         # Computing anomaly labels to compare with sklearn's isolation forest 
         log_predicted_anomaly_label = compute_anomaly_label(log_anomaly_scores)
 
-        # 4. Using sklearn's Isolation Forest model with the data
-        model = IsolationForest(contamination=0.01)
-        model.fit(log_dataset_val)
-        log_isolation_forest_anomalies = model.predict(log_dataset_val)
-
         # 5. Comparing implemented algorithn and sklearn's algorithm
         compare_results(log_predicted_anomaly_label, log_isolation_forest_anomalies)
-        visualize_data_and_anomalies(log_dataset_pd, np.array(log_predicted_anomaly_label), title='Anomalies in Starbucks (SBUX) Stock Price (with own algorithm)')
+        visualize_data_and_anomalies(log_dataset_pd, log_predicted_anomaly_label, title='Anomalies in Starbucks (SBUX) Stock Price (with own algorithm)')
         visualize_data_and_anomalies(log_dataset_pd, log_isolation_forest_anomalies, title='Anomalies in Starbucks (SBUX) Stock Price (with isolation forest)')
 
 # COMMAND ----------